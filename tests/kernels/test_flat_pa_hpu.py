@@ -0,0 +1,149 @@
+"""Compare the online-softmax flat paged attention decode path against
+ops.flat_pa.
+
+Run `pytest tests/kernels/test_flat_pa_hpu.py`.
+"""
+import math
+from typing import List
+
+import pytest
+import torch
+
+from vllm.platforms import current_platform
+
+if not current_platform.is_hpu():
+    pytest.skip(reason="Flat paged attention is only available on HPU.",
+                allow_module_level=True)
+
+from vllm_hpu_extension import ops
+from vllm_hpu_extension.utils import Matmul, VLLMKVCache
+
+from vllm.attention.ops.hpu_paged_attn import (flash_flat_pa_gqa,
+                                               flash_flat_pa_mha,
+                                               make_block_segments)
+
+NUM_BLOCKS = 64
+BLOCK_SIZE = 128
+HEAD_SIZE = 128
+# (num_heads, num_kv_heads)
+NUM_HEADS = [(8, 8), (32, 8), (8, 1)]
+# Sequences spanning one, a partial and several blocks
+SEQ_LENS = [[1, 130, 600], [2000, 7, 128, 129]]
+NUM_PADDING_BLOCKS = [0, 3]
+# Padding blocks are marked with -1 in lazy mode and with batch_size
+# otherwise.
+PADDING_GROUPS = ["minus_one", "batch_size"]
+DTYPES = [torch.bfloat16]
+TOLERANCES = {
+    torch.bfloat16: (2e-2, 2e-2),
+}
+
+
+def _make_metadata(seq_lens: List[int], num_padding_blocks: int,
+                   padding_group: str, dtype: torch.dtype, device: str):
+    batch_size = len(seq_lens)
+    num_seq_blocks = [math.ceil(seq_len / BLOCK_SIZE) for seq_len in seq_lens]
+    block_ids = torch.randperm(NUM_BLOCKS - 1)[:sum(num_seq_blocks)] + 1
+
+    block_list = block_ids.tolist() + [0] * num_padding_blocks
+    block_groups: List[int] = []
+    block_usage: List[int] = []
+    for seq_id, seq_len in enumerate(seq_lens):
+        num_blocks = num_seq_blocks[seq_id]
+        block_groups += [seq_id] * num_blocks
+        block_usage += [BLOCK_SIZE] * (num_blocks - 1)
+        block_usage.append(seq_len - (num_blocks - 1) * BLOCK_SIZE)
+    padding_id = -1 if padding_group == "minus_one" else batch_size
+    block_groups += [padding_id] * num_padding_blocks
+    block_usage += [1] * num_padding_blocks
+
+    block_list_t = torch.tensor(block_list, dtype=torch.long, device=device)
+    block_groups_t = torch.tensor(block_groups,
+                                  dtype=torch.long,
+                                  device=device)
+    block_usage_t = torch.tensor(block_usage, dtype=dtype, device=device)
+
+    mask = torch.arange(0, BLOCK_SIZE, device=device,
+                        dtype=torch.int32).unsqueeze(0)
+    mask = mask >= block_usage_t.unsqueeze(-1)
+    block_bias = torch.zeros_like(mask,
+                                  dtype=dtype).masked_fill_(mask, -math.inf)
+
+    padding = block_groups_t.lt(0) | block_groups_t.ge(batch_size)
+    block_mapping = block_groups_t.masked_fill(padding, 0)
+    block_mapping = torch.nn.functional.one_hot(block_mapping,
+                                                num_classes=batch_size)
+    block_mapping.masked_fill_(padding.unsqueeze(-1), 0)
+    block_mapping = block_mapping.to(dtype)
+
+    ones = torch.ones((block_mapping.size(0), ), device=device, dtype=dtype)
+    sums = ops.batch2block(ops.block2batch(ones, block_mapping), block_mapping)
+    block_scales = sums.clamp_min_(1.0).reciprocal_()
+
+    return dict(block_list=block_list_t,
+                block_mapping=block_mapping,
+                block_bias=block_bias,
+                block_scales=block_scales,
+                block_groups=block_groups_t.masked_fill(padding, batch_size),
+                block_segments=make_block_segments(block_groups_t, batch_size))
+
+
+@pytest.mark.parametrize("num_heads", NUM_HEADS)
+@pytest.mark.parametrize("seq_lens", SEQ_LENS)
+@pytest.mark.parametrize("num_padding_blocks", NUM_PADDING_BLOCKS)
+@pytest.mark.parametrize("padding_group", PADDING_GROUPS)
+@pytest.mark.parametrize("dtype", DTYPES)
+@torch.inference_mode()
+def test_flash_flat_pa(num_heads, seq_lens, num_padding_blocks, padding_group,
+                       dtype) -> None:
+    torch.manual_seed(0)
+    device = "hpu"
+    num_query_heads, num_kv_heads = num_heads
+    num_queries_per_kv = num_query_heads // num_kv_heads
+    batch_size = len(seq_lens)
+
+    query = torch.randn(batch_size,
+                        num_query_heads,
+                        HEAD_SIZE,
+                        dtype=dtype,
+                        device=device)
+    key_cache = torch.randn(NUM_BLOCKS,
+                            BLOCK_SIZE,
+                            num_kv_heads,
+                            HEAD_SIZE,
+                            dtype=dtype,
+                            device=device)
+    value_cache = torch.randn_like(key_cache)
+    metadata = _make_metadata(seq_lens, num_padding_blocks, padding_group,
+                              dtype, device)
+    block_segments = metadata.pop("block_segments")
+
+    k_cache = VLLMKVCache()
+    v_cache = VLLMKVCache()
+    kwargs = dict(key_cache=key_cache,
+                  value_cache=value_cache,
+                  scale=HEAD_SIZE**-0.5,
+                  matmul_qk_op=Matmul(),
+                  matmul_av_op=Matmul(),
+                  batch2block_matmul_op=Matmul(),
+                  block2batch_matmul_op=Matmul(),
+                  keys_fetch_func=k_cache.fetch_from_cache,
+                  values_fetch_func=v_cache.fetch_from_cache,
+                  **metadata)
+
+    expected = ops.flat_pa(query=query, **kwargs)
+    if num_queries_per_kv > 1:
+        grouped_query = query.unflatten(1, (num_kv_heads, num_queries_per_kv))
+        output = flash_flat_pa_gqa(query=grouped_query,
+                                   block_segments=block_segments,
+                                   **kwargs).flatten(1, 2)
+    else:
+        output = flash_flat_pa_mha(query=query,
+                                   block_segments=block_segments,
+                                   **kwargs)
+
+    rtol, atol = TOLERANCES[dtype]
+    torch.testing.assert_close(output.view_as(expected),
+                               expected,
+                               rtol=rtol,
+                               atol=atol)
@@ -0,0 +1,83 @@
+"""Tests for loading KV cache scaling factors from a quantization param
+JSON into the attention layers of LlamaModel.
+
+Run `pytest tests/model_executor/test_kv_cache_scales.py`.
+"""
+import json
+import os
+
+import pytest
+from torch import nn
+
+from vllm.model_executor.models import llama
+from vllm.model_executor.models.llama import LlamaModel
+from vllm.platforms import current_platform
+
+SCALES_PATH = os.path.join(os.path.dirname(__file__), "..", "fp8_kv",
+                           "llama2-7b-fp8-kv", "kv_cache_scales.json")
+NUM_HIDDEN_LAYERS = 32
+
+
+class _LlamaConfig:
+    model_type = "llama"
+    num_hidden_layers = NUM_HIDDEN_LAYERS
+
+
+class _Attention(nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self._k_scale = 1.0
+        self._v_scale = 1.0
+
+
+class _DecoderLayer(nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.self_attn = nn.Module()
+        self.self_attn.attn = _Attention()
+
+
+class _LlamaModel(nn.Module):
+
+    def __init__(self, layers):
+        super().__init__()
+        self.config = _LlamaConfig()
+        self.layers = nn.ModuleList(layers)
+
+
+@pytest.fixture
+def single_rank(monkeypatch):
+    monkeypatch.setattr(llama, "get_tensor_model_parallel_world_size",
+                        lambda: 1)
+    monkeypatch.setattr(llama, "get_tensor_model_parallel_rank", lambda: 0)
+
+
+@pytest.mark.parametrize("num_missing_layers", [0, 8])
+def test_load_kv_cache_scales(single_rank, num_missing_layers):
+    # Layers owned by other pipeline stages are PPMissingLayer, an Identity
+    num_present_layers = NUM_HIDDEN_LAYERS - num_missing_layers
+    layers = [_DecoderLayer() for _ in range(num_present_layers)]
+    layers += [nn.Identity() for _ in range(num_missing_layers)]
+    model = _LlamaModel(layers)
+
+    LlamaModel.load_kv_cache_scales(model, SCALES_PATH)
+
+    with open(SCALES_PATH) as f:
+        scales = json.load(f)["kv_cache"]["scaling_factor"]["0"]
+    multiplier = 2.0 if current_platform.is_rocm() else 1.0
+    for layer_idx in range(num_present_layers):
+        attn = model.layers[layer_idx].self_attn.attn
+        expected = scales[str(layer_idx)] * multiplier
+        assert attn._k_scale == pytest.approx(expected)
+        assert attn._v_scale == pytest.approx(expected)
+
+
+def test_load_kv_cache_scales_without_scale_attribute(single_rank):
+    layers = [_DecoderLayer() for _ in range(NUM_HIDDEN_LAYERS)]
+    layers[0].self_attn.attn = nn.Module()
+    model = _LlamaModel(layers)
+
+    with pytest.raises(RuntimeError, match="no KV cache scaling factor"):
+        LlamaModel.load_kv_cache_scales(model, SCALES_PATH)
@@ -0,0 +1,195 @@
+"""Tests for the checkpoint name handling of the Llama weight loaders.
+
+Run `pytest tests/model_executor/test_llama_weight_names.py`.
+"""
+import functools
+from types import SimpleNamespace
+
+import pytest
+import torch
+from torch import nn
+
+from vllm.model_executor.models.llama import LlamaForCausalLM, LlamaModel
+
+MISTRAL_NAMES = [
+    "tok_embeddings.weight",
+    "norm.weight",
+    "output.weight",
+    "layers.0.attention.wq.weight",
+    "layers.0.attention.wk.weight",
+    "layers.0.attention.wv.weight",
+    "layers.0.attention.wo.weight",
+    "layers.0.attention_norm.weight",
+    "layers.0.ffn_norm.weight",
+    "layers.0.feed_forward.w1.weight",
+    "layers.0.feed_forward.w2.weight",
+    "layers.0.feed_forward.w3.weight",
+    "layers.31.attention.wq.weight",
+    "layers.31.attention_norm.weight",
+    "layers.31.feed_forward.w3.weight",
+]
+HF_NAMES = [
+    "model.embed_tokens.weight",
+    "model.norm.weight",
+    "lm_head.weight",
+    "model.layers.0.self_attn.q_proj.weight",
+    "model.layers.0.self_attn.k_proj.weight",
+    "model.layers.0.self_attn.v_proj.weight",
+    "model.layers.0.self_attn.o_proj.weight",
+    "model.layers.0.input_layernorm.weight",
+    "model.layers.0.post_attention_layernorm.weight",
+    "model.layers.0.mlp.gate_proj.weight",
+    "model.layers.0.mlp.down_proj.weight",
+    "model.layers.0.mlp.up_proj.weight",
+    "model.layers.31.self_attn.q_proj.weight",
+]
+
+NUM_HEADS = 4
+NUM_KV_HEADS = 2
+HEAD_DIM = 8
+HIDDEN_SIZE = NUM_HEADS * HEAD_DIM
+
+
+def _reference_remap(name: str) -> str:
+    # The str.replace loop maybe_remap_mistral used before it switched to
+    # a single regex substitution.
+    mapping = LlamaForCausalLM.mistral_mapping
+    for item in name.split("."):
+        if item in mapping and mapping[item] not in name:
+            name = name.replace(item, mapping[item])
+    return name
+
+
+class _RecordingLoader:
+
+    def __init__(self):
+        self.loaded = []
+
+    def load_weights(self, weights):
+        self.loaded = list(weights)
+        return {name for name, _ in self.loaded}
+
+
+def _make_causal_lm():
+    model = SimpleNamespace(
+        _weights_loader=_RecordingLoader(),
+        config=SimpleNamespace(head_dim=HEAD_DIM,
+                               hidden_size=HIDDEN_SIZE,
+                               num_attention_heads=NUM_HEADS,
+                               num_key_value_heads=NUM_KV_HEADS),
+        mistral_mapping=LlamaForCausalLM.mistral_mapping,
+        mistral_name_pattern=LlamaForCausalLM.mistral_name_pattern,
+    )
+    model.maybe_remap_mistral = functools.partial(
+        LlamaForCausalLM.maybe_remap_mistral, model)
+    return model
+
+
+def _make_weight(name: str) -> torch.Tensor:
+    if "wq" in name.split("."):
+        return torch.randn(NUM_HEADS * HEAD_DIM, HIDDEN_SIZE)
+    if "wk" in name.split("."):
+        return torch.randn(NUM_KV_HEADS * HEAD_DIM, HIDDEN_SIZE)
+    return torch.randn(HIDDEN_SIZE)
+
+
+@pytest.mark.parametrize("name", MISTRAL_NAMES + HF_NAMES)
+def test_maybe_remap_mistral_matches_reference(name):
+    model = _make_causal_lm()
+    remapped, _ = model.maybe_remap_mistral(name, _make_weight(name))
+    assert remapped == _reference_remap(name)
+
+
+@pytest.mark.parametrize("name", HF_NAMES)
+def test_maybe_remap_mistral_keeps_hf_names(name):
+    model = _make_causal_lm()
+    remapped, _ = model.maybe_remap_mistral(name, _make_weight(name))
+    assert remapped == name
+
+
+def test_load_weights_remaps_mistral_checkpoint():
+    model = _make_causal_lm()
+    weights = [(name, _make_weight(name)) for name in MISTRAL_NAMES]
+
+    loaded = LlamaForCausalLM.load_weights(model, weights)
+
+    expected = [_reference_remap(name) for name in MISTRAL_NAMES]
+    assert [name for name, _ in model._weights_loader.loaded] == expected
+    assert loaded == set(expected)
+
+
+def test_load_weights_passes_hf_checkpoint_through():
+    model = _make_causal_lm()
+    weights = [(name, _make_weight(name)) for name in HF_NAMES]
+
+    LlamaForCausalLM.load_weights(model, iter(weights))
+
+    loaded = model._weights_loader.loaded
+    assert [name for name, _ in loaded] == HF_NAMES
+    assert all(tensor is weight
+               for (_, tensor), (_, weight) in zip(loaded, weights))
+
+
+def test_load_weights_empty_checkpoint():
+    model = _make_causal_lm()
+
+    assert LlamaForCausalLM.load_weights(model, iter([])) == set()
+    assert model._weights_loader.loaded == []
+
+
+def _make_llama_model(calls):
+
+    def make_module(*param_names):
+        module = nn.Module()
+        for param_name in param_names:
+            param = nn.Parameter(torch.empty(0), requires_grad=False)
+            param.weight_loader = record
+            module.register_parameter(param_name, param)
+        return module
+
+    def record(param, loaded_weight, *shard_id):
+        calls.append((param, *shard_id))
+
+    layer = nn.Module()
+    layer.self_attn = nn.Module()
+    layer.self_attn.qkv_proj = make_module("weight", "bias")
+    layer.self_attn.o_proj = make_module("weight")
+    layer.mlp = nn.Module()
+    layer.mlp.gate_up_proj = make_module("qweight", "weight_scale")
+    model = nn.Module()
+    model.layers = nn.ModuleList([layer])
+    model.stacked_params_mapping = LlamaModel.stacked_params_mapping
+    return model
+
+
+@pytest.mark.parametrize("checkpoint_name,param_name,shard_id", [
+    ("layers.0.self_attn.q_proj.weight", "layers.0.self_attn.qkv_proj.weight",
+     "q"),
+    ("layers.0.self_attn.k_proj.bias", "layers.0.self_attn.qkv_proj.bias",
+     "k"),
+    ("layers.0.mlp.gate_proj.qweight", "layers.0.mlp.gate_up_proj.qweight", 0),
+    ("layers.0.mlp.up_proj.weight_scale",
+     "layers.0.mlp.gate_up_proj.weight_scale", 1),
+])
+def test_load_weights_stacked_params(checkpoint_name, param_name, shard_id):
+    calls = []
+    model = _make_llama_model(calls)
+
+    loaded = LlamaModel.load_weights(model,
+                                     [(checkpoint_name, torch.empty(0))])
+
+    params = dict(model.named_parameters())
+    assert loaded == {param_name}
+    assert calls == [(params[param_name], shard_id)]
+
+
+def test_load_weights_unstacked_param():
+    calls = []
+    model = _make_llama_model(calls)
+    name = "layers.0.self_attn.o_proj.weight"
+
+    loaded = LlamaModel.load_weights(model, [(name, torch.empty(0))])
+
+    # Loaded through the default path, without a shard id
+    assert loaded == {name}
+    assert calls == [(dict(model.named_parameters())[name], )]
@@ -3,8 +3,9 @@
 ###############################################################################
 
 import os
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple, Type
+from dataclasses import dataclass, fields
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Set, Tuple, Type
 
 import torch
 import vllm_hpu_extension.ops as ops
@@ -30,6 +31,28 @@ except ImportError:
                    "vLLM will use native implementation.")
 
 
+@dataclass(frozen=True)
+class HPUAttentionFlags:
+    """Attention settings read from the environment."""
+    # Use FusedSDPA for prompts (VLLM_PROMPT_USE_FUSEDSDPA)
+    prefill_use_fusedsdpa: bool
+    # Use the online-softmax decode path (VLLM_HPU_FLASH_DECODE)
+    use_flash_decode: bool
+
+
+@lru_cache(maxsize=None)
+def get_hpu_attention_flags() -> HPUAttentionFlags:
+    """Resolve the attention flags once per process, rather than once per
+    attention layer."""
+    prefill_use_fusedsdpa = os.getenv('VLLM_PROMPT_USE_FUSEDSDPA',
+                                      '1').lower() in ['1', 'true'] \
+                                      and not is_fake_hpu()
+    use_flash_decode = os.getenv('VLLM_HPU_FLASH_DECODE',
+                                 '0').lower() in ['1', 'true']
+    return HPUAttentionFlags(prefill_use_fusedsdpa=prefill_use_fusedsdpa,
+                             use_flash_decode=use_flash_decode)
+
+
 class HPUAttentionBackend(AttentionBackend):
 
     @staticmethod
@@ -74,6 +97,34 @@ class HPUAttentionBackend(AttentionBackend):
         HPUPagedAttention.copy_blocks(kv_caches, src_to_dsts)
 
 
+@dataclass
+class HPUCrossAttentionMetadata:
+    """Paged attention metadata of the encoder-decoder cross-attention."""
+    block_indices: Optional[torch.Tensor] = None
+    block_offsets: Optional[torch.Tensor] = None
+    block_list: Optional[torch.Tensor] = None
+    slot_mapping: Optional[torch.Tensor] = None
+    block_mapping: Optional[torch.Tensor] = None
+    block_groups: Optional[torch.Tensor] = None
+    block_segments: Optional[torch.Tensor] = None
+    block_scales: Optional[torch.Tensor] = None
+    block_usage: Optional[torch.Tensor] = None
+    attn_bias: Optional[torch.Tensor] = None
+
+    @classmethod
+    def pop_from_dict(
+            cls,
+            tensor_dict: Dict[str,
+                              Any]) -> Optional["HPUCrossAttentionMetadata"]:
+        """Rebuild the metadata flattened by asdict_zerocopy of
+        HPUAttentionMetadata, removing its entries from tensor_dict."""
+        values = {
+            f.name: tensor_dict.pop(f"cross_{f.name}")
+            for f in fields(cls) if f"cross_{f.name}" in tensor_dict
+        }
+        return cls(**values) if values else None
+
+
 @dataclass
 class HPUAttentionMetadata(HPUPagedAttentionMetadata, AttentionMetadata):
     """Metadata for HPUAttentionbackend."""
@@ -86,15 +137,23 @@ class HPUAttentionMetadata(HPUPagedAttentionMetadata, AttentionMetadata):
     seq_lens: Optional[List[int]] = None
     encoder_seq_lens: Optional[List[int]] = None
     encoder_seq_lens_tensor: Optional[torch.Tensor] = None
-    cross_block_indices: Optional[torch.Tensor] = None
-    cross_block_offsets: Optional[torch.Tensor] = None
-    cross_block_list: Optional[torch.Tensor] = None
-    cross_slot_mapping: Optional[torch.Tensor] = None
-    cross_block_mapping: Optional[torch.Tensor] = None
-    cross_block_groups: Optional[torch.Tensor] = None
-    cross_block_scales: Optional[torch.Tensor] = None
-    cross_block_usage: Optional[torch.Tensor] = None
-    cross_attn_bias: Optional[torch.Tensor] = None
+    # Only set for encoder-decoder models.
+    cross: Optional[HPUCrossAttentionMetadata] = None
+
+    def asdict_zerocopy(self,
+                        skip_fields: Optional[Set[str]] = None
+                        ) -> Dict[str, Any]:
+        if skip_fields is None:
+            skip_fields = set()
+        result = super().asdict_zerocopy(skip_fields | {"cross"})
+        # Flatten the cross-attention metadata, so that its tensors are
+        # broadcast like any other top-level tensor field.
+        if self.cross is not None and "cross" not in skip_fields:
+            result.update({
+                f"cross_{f.name}": getattr(self.cross, f.name)
+                for f in fields(self.cross)
+            })
+        return result
 
 
 class HPUAttentionImpl(AttentionImpl, torch.nn.Module):
@@ -150,18 +209,41 @@ class HPUAttentionImpl(AttentionImpl, torch.nn.Module):
         assert self.num_heads % self.num_kv_heads == 0
         self.num_queries_per_kv = self.num_heads // self.num_kv_heads
 
-        self.prefill_use_fusedsdpa = os.getenv('VLLM_PROMPT_USE_FUSEDSDPA',
-                                               '1').lower() in ['1', 'true'] \
-                                               and not is_fake_hpu()
+        flags = get_hpu_attention_flags()
+        self.prefill_use_fusedsdpa = flags.prefill_use_fusedsdpa
         if self.prefill_use_fusedsdpa:
             assert alibi_slopes is None, \
                 'Prefill with FusedSDPA not supported with alibi slopes!'
 
+        self.use_flash_decode = flags.use_flash_decode
+        # The head layout is fixed per layer, so pick the flash decode
+        # variant specialized for it once instead of branching every step.
+        # The GQA variant takes queries already grouped per KV head, which
+        # saves an unflatten/flatten pair as well.
+        decode_heads: Tuple[int, ...] = (self.num_heads, )
+        if not self.use_flash_decode:
+            self.forward_decode = HPUPagedAttention.forward_decode
+        elif self.num_queries_per_kv > 1:
+            self.forward_decode = HPUPagedAttention.forward_flash_decode_gqa
+            decode_heads = (self.num_kv_heads, self.num_queries_per_kv)
+        else:
+            self.forward_decode = HPUPagedAttention.forward_flash_decode_mha
+        self._decode_query_shape = (-1, *decode_heads, self.head_size)
+
         suppored_head_sizes = HPUPagedAttention.get_supported_head_sizes()
         if head_size not in suppored_head_sizes:
             raise ValueError(
                 f"Head size {head_size} is not supported by PagedAttention. "
                 f"Supported head sizes are: {suppored_head_sizes}.")
+        if kv_cache_dtype not in ("auto", "fp8_inc"):
+            # FP8 KV cache on Gaudi is provided by INC, which swaps in
+            # quantizing cache writers and calibrated FP8 matmuls. A raw
+            # fp8 cache dtype would store unscaled values and feed them to
+            # the bf16 matmuls of the decode path.
+            raise NotImplementedError(
+                f"KV cache dtype {kv_cache_dtype} is not supported by "
+                "HPUAttentionImpl. Use --kv-cache-dtype fp8_inc together "
+                "with --quantization inc for an FP8 KV cache.")
 
     def forward(
         self,
@@ -240,9 +322,10 @@ class HPUAttentionImpl(AttentionImpl, torch.nn.Module):
                         position_bias = _make_alibi_bias(
                             self.alibi_slopes, self.num_kv_heads,
                             attn_bias.dtype, attn_bias.shape[-1])
-                        attn_bias = attn_bias.tile(
-                            (1, self.num_kv_heads, 1, 1))
-                        attn_bias.add_(position_bias)
+                        # Broadcast the [B, 1, L, L] mask over the heads of
+                        # the [1, H, L, L] bias in a single out-of-place add
+                        # rather than tiling the mask first.
+                        attn_bias = attn_bias + position_bias
                 else:
                     attn_bias = None
 
@@ -278,8 +361,8 @@ class HPUAttentionImpl(AttentionImpl, torch.nn.Module):
             output = out.reshape(batch_size, seq_len, hidden_size)
         else:
             # Decoding run.
-            output = HPUPagedAttention.forward_decode(
-                query=query,
+            output = self.forward_decode(
+                query=query.view(self._decode_query_shape),
                 key_cache=key_cache,
                 value_cache=value_cache,
                 block_list=attn_metadata.block_list,
@@ -287,6 +370,7 @@ class HPUAttentionImpl(AttentionImpl, torch.nn.Module):
                 block_bias=attn_metadata.attn_bias,
                 block_scales=attn_metadata.block_scales,
                 block_groups=attn_metadata.block_groups,
+                block_segments=attn_metadata.block_segments,
                 scale=self.scale,
                 matmul_qk_op=self.matmul_qk,
                 matmul_av_op=self.matmul_av,
@@ -338,8 +422,9 @@ class HPUAttentionImpl(AttentionImpl, torch.nn.Module):
         else:
             assert value is None
 
-        block_indices = attn_metadata.cross_block_indices
-        block_offsets = attn_metadata.cross_block_offsets
+        cross_metadata = attn_metadata.cross
+        block_indices = cross_metadata.block_indices
+        block_offsets = cross_metadata.block_offsets
         if kv_cache is not None:
             key_cache, value_cache = HPUPagedAttention.split_kv_cache(
                 kv_cache, self.num_kv_heads, self.head_size)
@@ -383,14 +468,15 @@ class HPUAttentionImpl(AttentionImpl, torch.nn.Module):
         else:
             # Enc/dec cross-attention KVs match encoder sequence length;
             # cross-attention utilizes special "cross" block tables
-            block_list = attn_metadata.cross_block_list
-            block_mapping = attn_metadata.cross_block_mapping
-            block_scales = attn_metadata.cross_block_scales
-            block_groups = attn_metadata.cross_block_groups
-            attn_bias = attn_metadata.cross_attn_bias
+            block_list = cross_metadata.block_list
+            block_mapping = cross_metadata.block_mapping
+            block_scales = cross_metadata.block_scales
+            block_groups = cross_metadata.block_groups
+            block_segments = cross_metadata.block_segments
+            attn_bias = cross_metadata.attn_bias
             # Decoding run.
-            output = HPUPagedAttention.forward_decode(
-                query=query,
+            output = self.forward_decode(
+                query=query.view(self._decode_query_shape),
                 key_cache=key_cache,
                 value_cache=value_cache,
                 block_list=block_list,
@@ -398,6 +484,7 @@ class HPUAttentionImpl(AttentionImpl, torch.nn.Module):
                 block_bias=attn_bias,
                 block_scales=block_scales,
                 block_groups=block_groups,
+                block_segments=block_segments,
                 scale=self.scale,
                 matmul_qk_op=self.matmul_qk,
                 matmul_av_op=self.matmul_av,
@@ -2,6 +2,7 @@
 # Copyright (C) 2024 Habana Labs, Ltd. an Intel Company
 ###############################################################################
 
+import math
 from dataclasses import dataclass
 from typing import List, Optional, Tuple
 
@@ -22,6 +23,134 @@ class HPUPagedAttentionMetadata:
     block_offsets: Optional[torch.Tensor]
     block_scales: Optional[torch.Tensor]
     block_groups: Optional[torch.Tensor]
+    block_segments: Optional[torch.Tensor]
+
+
+def make_block_segments(block_groups: torch.Tensor,
+                        batch_size: int) -> torch.Tensor:
+    """Segment ids of the blocks for the flash decode merge.
+
+    Padding blocks are marked either with -1 or with batch_size in
+    block_groups depending on the execution mode. Both are routed to an
+    extra trailing segment, so they never contribute to the statistics of
+    a real sequence.
+    """
+    groups = block_groups.to(torch.long)
+    return groups.masked_fill(groups.lt(0), batch_size)
+
+
+def _segment_sum(tensor: torch.Tensor, segments: torch.Tensor,
+                 batch_size: int) -> torch.Tensor:
+    group_sums = torch.zeros((batch_size + 1, ) + tuple(tensor.shape[1:]),
+                             dtype=tensor.dtype,
+                             device=tensor.device)
+    group_sums.index_add_(0, segments, tensor)
+    group_sums[batch_size] = 0
+    return group_sums.index_select(0, segments)
+
+
+def _segment_max(tensor: torch.Tensor, segments: torch.Tensor,
+                 batch_size: int) -> torch.Tensor:
+    group_max = torch.full((batch_size + 1, ) + tuple(tensor.shape[1:]),
+                           -math.inf,
+                           dtype=tensor.dtype,
+                           device=tensor.device)
+    group_max.index_reduce_(0, segments, tensor, 'amax')
+    return group_max.index_select(0, segments)
+
+
+def _flash_attn_blocks(query: torch.Tensor, key: torch.Tensor,
+                       value: torch.Tensor, block_bias: torch.Tensor,
+                       block_mapping: torch.Tensor, segments: torch.Tensor,
+                       scale: float, matmul_qk_op, matmul_av_op,
+                       block2batch_matmul_op) -> torch.Tensor:
+    """Flat paged attention using the online-softmax recurrence.
+
+    Every block produces its own partial statistics (running max m,
+    normalizer l and unnormalized output o). Partials of blocks belonging
+    to the same sequence are then merged with the FlashAttention rescaling
+    rule, so the scores never have to be normalized against a full,
+    sequence-wide softmax row.
+    """
+    batch_size = block_mapping.size(1)
+
+    # Per-block partials: m_b = max(s), l_b = sum(exp(s - m_b)) and
+    # o_b = exp(s - m_b) @ V. Scores and the V matmul stay in the native
+    # dtype, only the per-block statistics are accumulated in fp32.
+    # Scale is applied together with the bias, in the QK matmul epilogue,
+    # rather than on a separate scaled copy of the query.
+    attn = torch.add(block_bias, matmul_qk_op(query, key), alpha=scale)
+    block_max = attn.amax(dim=-1, keepdim=True)
+    attn = attn.sub_(block_max).exp_()
+    block_sums = attn.sum(dim=-1, keepdim=True, dtype=torch.float32)
+    attn = matmul_av_op(attn, value)
+    block_max = block_max.float()
+
+    # Merge the partials of each sequence: with m = max(m_b) and
+    # alpha_b = exp(m_b - m), l = sum(alpha_b * l_b), o = sum(alpha_b * o_b) / l
+    group_max = _segment_max(block_max, segments, batch_size)
+    block_adjustment = (block_max - group_max).exp_()
+    sum_adjusted = block_sums.mul_(block_adjustment)
+    group_sums = _segment_sum(sum_adjusted, segments, batch_size)
+    # Guard against sums zeroed out during block aggregation
+    group_sums = group_sums.clamp_min_(sum_adjusted)
+    rescale = block_adjustment.div_(group_sums)
+    attn = attn.mul_(rescale.to(attn.dtype))
+
+    return ops.block2batch(attn, block_mapping,
+                           block2batch_matmul_op).squeeze(-2)
+
+
+def flash_flat_pa_mha(query: torch.Tensor, key_cache: torch.Tensor,
+                      value_cache: torch.Tensor, block_list: torch.Tensor,
+                      block_mapping: torch.Tensor, block_bias: torch.Tensor,
+                      block_scales: torch.Tensor, block_groups: torch.Tensor,
+                      scale: float, matmul_qk_op, matmul_av_op,
+                      batch2block_matmul_op, block2batch_matmul_op,
+                      keys_fetch_func, values_fetch_func,
+                      block_segments: torch.Tensor) -> torch.Tensor:
+    """Online-softmax flat paged attention for num_heads == num_kv_heads.
+
+    Takes the same arguments as ops.flat_pa plus the block_segments from
+    make_block_segments. query is [batch_size, num_heads, head_size].
+    """
+    query = ops.batch2block(query, block_mapping,
+                            batch2block_matmul_op).unsqueeze(-2)
+    # Cached blocks are [num_blocks, block_size, kv_heads, head_size]. Go
+    # straight to the [num_blocks, kv_heads, head_size, block_size] operand
+    # of the QK matmul with a single permute, instead of transposing to the
+    # head-major layout first and then swapping the last two axes.
+    key = keys_fetch_func(key_cache, block_list).permute(0, 2, 3, 1)
+    value = values_fetch_func(value_cache, block_list).transpose(1, 2)
+    block_bias = block_bias.view(key.size(0), 1, 1, -1)
+    return _flash_attn_blocks(query, key, value, block_bias, block_mapping,
+                              block_segments, scale, matmul_qk_op,
+                              matmul_av_op, block2batch_matmul_op)
+
+
+def flash_flat_pa_gqa(query: torch.Tensor, key_cache: torch.Tensor,
+                      value_cache: torch.Tensor, block_list: torch.Tensor,
+                      block_mapping: torch.Tensor, block_bias: torch.Tensor,
+                      block_scales: torch.Tensor, block_groups: torch.Tensor,
+                      scale: float, matmul_qk_op, matmul_av_op,
+                      batch2block_matmul_op, block2batch_matmul_op,
+                      keys_fetch_func, values_fetch_func,
+                      block_segments: torch.Tensor) -> torch.Tensor:
+    """Online-softmax flat paged attention for grouped-query attention.
+
+    query is grouped per KV head, [batch_size, kv_heads, queries_per_kv,
+    head_size], and the output keeps that shape.
+    """
+    query = ops.batch2block(query, block_mapping,
+                            batch2block_matmul_op).unsqueeze(-2)
+    key = keys_fetch_func(key_cache, block_list).permute(0, 2, 3, 1)
+    value = values_fetch_func(value_cache, block_list).transpose(1, 2)
+    key = key.unsqueeze(2)
+    value = value.unsqueeze(2)
+    block_bias = block_bias.view(key.size(0), 1, 1, 1, -1)
+    return _flash_attn_blocks(query, key, value, block_bias, block_mapping,
+                              block_segments, scale, matmul_qk_op,
+                              matmul_av_op, block2batch_matmul_op)
 
 
 class HPUPagedAttention:
@@ -59,9 +188,19 @@ class HPUPagedAttention:
                                     slot_mapping, kv_cache_dtype, is_prompt)
 
     @staticmethod
-    def forward_decode(**kwargs) -> torch.Tensor:
+    def forward_decode(block_segments: Optional[torch.Tensor] = None,
+                       **kwargs) -> torch.Tensor:
+        # block_segments is only consumed by the flash decode path
         return ops.flat_pa(**kwargs)
 
+    @staticmethod
+    def forward_flash_decode_mha(**kwargs) -> torch.Tensor:
+        return flash_flat_pa_mha(**kwargs)
+
+    @staticmethod
+    def forward_flash_decode_gqa(**kwargs) -> torch.Tensor:
+        return flash_flat_pa_gqa(**kwargs)
+
     @staticmethod
     def forward_prefix(**kwargs) -> torch.Tensor:
         return ops.prompt_attention_with_context(**kwargs)
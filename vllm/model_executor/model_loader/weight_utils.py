@@ -408,6 +408,11 @@ def safetensors_weights_iterator(
             for name in f.keys():  # noqa: SIM118
                 param = f.get_tensor(name)
                 yield name, param
+            if current_platform.is_hpu():
+                # Flush the copies issued for this shard once it is fully
+                # consumed rather than after every tensor, while the file
+                # backing its tensors is still open.
+                torch.hpu.synchronize()
 
 
 def pt_weights_iterator(
@@ -424,6 +429,8 @@ def pt_weights_iterator(
     ):
         state = torch.load(bin_file, map_location="cpu")
         yield from state.items()
+        if current_platform.is_hpu():
+            torch.hpu.synchronize()
         del state
         torch.cuda.empty_cache()
 
@@ -21,6 +21,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Inference-only LLaMA model compatible with HuggingFace weights."""
+import contextlib
+import itertools
+import re
 from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Type, Union
 
 import torch
@@ -59,6 +62,9 @@ from .utils import (AutoWeightsLoader, PPMissingLayer, extract_layer_index,
 
 is_hpu = current_platform.is_hpu()
 
+if is_hpu:
+    import habana_frameworks.torch as htorch
+
 
 class LlamaMLP(nn.Module):
 
@@ -115,7 +121,6 @@ class LlamaAttention(nn.Module):
         prefix: str = "",
     ) -> None:
         super().__init__()
-        layer_idx = extract_layer_index(prefix)
         self.hidden_size = hidden_size
         tp_size = get_tensor_model_parallel_world_size()
         self.total_num_heads = num_heads
@@ -175,6 +180,9 @@ class LlamaAttention(nn.Module):
             if isinstance(config.interleaved_sliding_window, int):
                 sliding_window = config.interleaved_sliding_window
             elif isinstance(config.interleaved_sliding_window, list):
+                # Only per-layer window patterns need the layer index, so
+                # the prefix is parsed just for those configs.
+                layer_idx = extract_layer_index(prefix)
                 sw_idx = layer_idx % len(config.interleaved_sliding_window)
                 sliding_window = config.interleaved_sliding_window[sw_idx]
             else:
@@ -287,6 +295,15 @@ class LlamaDecoderLayer(nn.Module):
 
 @support_torch_compile
 class LlamaModel(nn.Module):
+    # Checkpoint modules that are stacked into a fused parameter,
+    # shard_name: (param_name, shard_id)
+    stacked_params_mapping: Dict[str, Tuple[str, Union[int, str]]] = {
+        "q_proj": ("qkv_proj", "q"),
+        "k_proj": ("qkv_proj", "k"),
+        "v_proj": ("qkv_proj", "v"),
+        "gate_proj": ("gate_up_proj", 0),
+        "up_proj": ("gate_up_proj", 1),
+    }
 
     def __init__(self,
                  *,
@@ -357,7 +374,6 @@ class LlamaModel(nn.Module):
             residual = intermediate_tensors["residual"]
 
         if is_hpu:
-            import habana_frameworks.torch as htorch
             htorch.core.mark_step()
 
         for i in range(self.start_layer, self.end_layer):
@@ -376,14 +392,6 @@ class LlamaModel(nn.Module):
 
     def load_weights(self, weights: Iterable[Tuple[str,
                                                    torch.Tensor]]) -> Set[str]:
-        stacked_params_mapping = [
-            # (param_name, shard_name, shard_id)
-            (".qkv_proj", ".q_proj", "q"),
-            (".qkv_proj", ".k_proj", "k"),
-            (".qkv_proj", ".v_proj", "v"),
-            (".gate_up_proj", ".gate_proj", 0),
-            (".gate_up_proj", ".up_proj", 1),
-        ]
         params_dict = dict(self.named_parameters())
         loaded_params: Set[str] = set()
         for name, loaded_weight in weights:
@@ -403,10 +411,14 @@ class LlamaModel(nn.Module):
                 weight_loader(param, loaded_weight)
                 loaded_params.add(scale_name)
                 continue
-            for param_name, weight_name, shard_id in stacked_params_mapping:
-                if weight_name not in name:
-                    continue
-                name = name.replace(weight_name, param_name)
+            # Checkpoint names are "<parent>.<module>.<param>", so a single
+            # lookup on the module name finds the fused parameter, if any.
+            module_path, _, param_attr = name.rpartition(".")
+            parent, _, module_name = module_path.rpartition(".")
+            stacked = self.stacked_params_mapping.get(module_name)
+            if stacked is not None:
+                param_name, shard_id = stacked
+                name = f"{parent}.{param_name}.{param_attr}"
                 # Skip loading extra bias for GPTQ models.
                 if name.endswith(".bias") and name not in params_dict:
                     continue
@@ -417,7 +429,6 @@ class LlamaModel(nn.Module):
                 param = params_dict[name]
                 weight_loader = param.weight_loader
                 weight_loader(param, loaded_weight, shard_id)
-                break
             else:
                 # Skip loading extra bias for GPTQ models.
                 if name.endswith(".bias") and name not in params_dict:
@@ -435,8 +446,10 @@ class LlamaModel(nn.Module):
                                         default_weight_loader)
                 weight_loader(param, loaded_weight)
             loaded_params.add(name)
-            if is_hpu:
-                torch.hpu.synchronize()
+        if is_hpu:
+            # The safetensors and pt iterators already synchronize after
+            # every shard file; the other loaders rely on this final sync.
+            torch.hpu.synchronize()
         return loaded_params
 
     # If this function is called, it should always initialize KV cache scale
@@ -445,24 +458,29 @@ class LlamaModel(nn.Module):
     def load_kv_cache_scales(self, quantization_param_path: str) -> None:
         tp_size = get_tensor_model_parallel_world_size()
         tp_rank = get_tensor_model_parallel_rank()
+        # The scaling factor convention we are assuming is
+        # quantized_value * scaling_factor ~= true_value
+        # which is consistent with the practice of setting
+        # scaling_factor = tensor_amax / FPtype_max
+        scale_multiplier = 2.0 if current_platform.is_rocm() else 1.0
+        attns = [
+            None if isinstance(layer, nn.Identity) else layer.self_attn.attn
+            for layer in self.layers
+        ]
+        if any(attn is not None and not hasattr(attn, "_k_scale")
+               for attn in attns):
+            raise RuntimeError("Self attention has no KV cache scaling "
+                               "factor attribute!")
         for layer_idx, scaling_factor in kv_cache_scales_loader(
                 quantization_param_path, tp_rank, tp_size,
                 self.config.num_hidden_layers,
                 self.config.__class__.model_type):
-            if not isinstance(self.layers[layer_idx], nn.Identity):
-                layer_self_attn = self.layers[layer_idx].self_attn
-
-            if current_platform.is_rocm():
-                # The scaling factor convention we are assuming is
-                # quantized_value * scaling_factor ~= true_value
-                # which is consistent with the practice of setting
-                # scaling_factor = tensor_amax / FPtype_max
-                scaling_factor *= 2
-            if hasattr(layer_self_attn, "kv_scale"):
-                layer_self_attn.attn._kv_scale = scaling_factor
-            else:
-                raise RuntimeError("Self attention has no KV cache scaling "
-                                   "factor attribute!")
+            attn = attns[layer_idx]
+            # Layers owned by other pipeline stages have nothing to scale
+            if attn is None:
+                continue
+            attn._k_scale = scaling_factor * scale_multiplier
+            attn._v_scale = scaling_factor * scale_multiplier
 
 
 class LlamaForCausalLM(nn.Module, SupportsLoRA, SupportsPP):
@@ -511,6 +529,10 @@ class LlamaForCausalLM(nn.Module, SupportsLoRA, SupportsPP):
         "output": "lm_head",
         "norm": "model.norm"
     }
+    # Matches whole dot-separated components of a name that need remapping
+    mistral_name_pattern = re.compile(
+        r"(?<![^.])(" + "|".join(map(re.escape, mistral_mapping)) +
+        r")(?![^.])")
 
     def __init__(self, *, vllm_config: VllmConfig, prefix: str = ""):
         super().__init__()
@@ -527,19 +549,26 @@ class LlamaForCausalLM(nn.Module, SupportsLoRA, SupportsPP):
             self.unpadded_vocab_size = config.vocab_size
             if lora_config:
                 self.unpadded_vocab_size += lora_config.lora_extra_vocab_size
-            self.lm_head = ParallelLMHead(
-                self.unpadded_vocab_size,
-                config.hidden_size,
-                org_num_embeddings=config.vocab_size,
-                padding_size=(
-                    DEFAULT_VOCAB_PADDING_SIZE
-                    # We need bigger padding if using lora for kernel
-                    # compatibility
-                    if not lora_config else
-                    lora_config.lora_vocab_padding_size),
-                quant_config=quant_config,
-                prefix=maybe_prefix(prefix, "lm_head"),
-            )
+            # An unquantized tied head only ends up holding the embedding
+            # weight, so build it on the meta device instead of allocating
+            # a vocab_size x hidden_size weight that is dropped right away.
+            lm_head_device = (
+                torch.device("meta") if config.tie_word_embeddings
+                and quant_config is None else contextlib.nullcontext())
+            with lm_head_device:
+                self.lm_head = ParallelLMHead(
+                    self.unpadded_vocab_size,
+                    config.hidden_size,
+                    org_num_embeddings=config.vocab_size,
+                    padding_size=(
+                        DEFAULT_VOCAB_PADDING_SIZE
+                        # We need bigger padding if using lora for kernel
+                        # compatibility
+                        if not lora_config else
+                        lora_config.lora_vocab_padding_size),
+                    quant_config=quant_config,
+                    prefix=maybe_prefix(prefix, "lm_head"),
+                )
             if config.tie_word_embeddings:
                 self.lm_head = self.lm_head.tie_weights(
                     self.model.embed_tokens)
@@ -556,6 +585,12 @@ class LlamaForCausalLM(nn.Module, SupportsLoRA, SupportsPP):
         self.make_empty_intermediate_tensors = (
             self.model.make_empty_intermediate_tensors)
 
+        self._weights_loader = AutoWeightsLoader(
+            self,
+            skip_prefixes=(["lm_head."]
+                           if config.tie_word_embeddings else None),
+        )
+
     def _init_model(self, vllm_config: VllmConfig, prefix: str = ""):
         return LlamaModel(vllm_config=vllm_config, prefix=prefix)
 
@@ -592,14 +627,20 @@ class LlamaForCausalLM(nn.Module, SupportsLoRA, SupportsPP):
 
     def load_weights(self, weights: Iterable[Tuple[str,
                                                    torch.Tensor]]) -> Set[str]:
-        loader = AutoWeightsLoader(
-            self,
-            skip_prefixes=(["lm_head."]
-                           if self.config.tie_word_embeddings else None),
-        )
+        loader = self._weights_loader
+        weights = iter(weights)
+        first = next(weights, None)
+        if first is None:
+            return loader.load_weights(weights)
+        weights = itertools.chain((first, ), weights)
+        # Only consolidated Mistral checkpoints need remapping and their
+        # names never start with an HF module name such as "model." or
+        # "lm_head.", so the format can be told from the first weight.
+        if first[0].split(".", 1)[0] not in self.mistral_mapping:
+            return loader.load_weights(weights)
+        remap = self.maybe_remap_mistral
         return loader.load_weights(
-            self.maybe_remap_mistral(name, loaded_weight)
-            for name, loaded_weight in weights)
+            remap(name, loaded_weight) for name, loaded_weight in weights)
 
     def load_kv_cache_scales(self, quantization_param_path: str) -> None:
         self.model.load_kv_cache_scales(quantization_param_path)
@@ -630,8 +671,11 @@ class LlamaForCausalLM(nn.Module, SupportsLoRA, SupportsPP):
             loaded_weight = permute(loaded_weight,
                                     self.config.num_attention_heads)
 
-        for item in modules:
-            if item in mapping and mapping[item] not in name:
-                name = name.replace(item, mapping[item])
+        def remap(match: re.Match) -> str:
+            item = match.group(0)
+            # Names already in HF format must stay as they are
+            return item if mapping[item] in name else mapping[item]
+
+        name = self.mistral_name_pattern.sub(remap, name)
 
         return name, loaded_weight
@@ -483,6 +483,8 @@ class MixtralForCausalLM(nn.Module, SupportsLoRA, SupportsPP):
                                             default_weight_loader)
                     weight_loader(param, loaded_weight)
             loaded_params.add(name)
-            if current_platform.is_hpu():
-                torch.hpu.synchronize()
+        if current_platform.is_hpu():
+            # The safetensors and pt iterators already synchronize after
+            # every shard file; the other loaders rely on this final sync.
+            torch.hpu.synchronize()
         return loaded_params
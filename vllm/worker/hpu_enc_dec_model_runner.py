@@ -11,6 +11,8 @@ import torch
 from vllm_hpu_extension.ops import batch2block, block2batch
 
 from vllm.attention import AttentionMetadata
+from vllm.attention.backends.hpu_attn import HPUCrossAttentionMetadata
+from vllm.attention.ops.hpu_paged_attn import make_block_segments
 from vllm.logger import init_logger
 from vllm.model_executor.layers.sampler import SamplerOutput
 from vllm.sampling_params import SamplingParams
@@ -53,52 +55,62 @@ class HpuModelAdapterEncoderDecoder(HpuModelAdapter):
                             device=device,
                             dtype=torch.int32).unsqueeze(0)
 
-        cross_attn_mask = mask >= metadata.cross_block_usage.unsqueeze(-1)
+        cross_metadata = metadata.cross
+        cross_attn_mask = mask >= cross_metadata.block_usage.unsqueeze(-1)
         cross_attn_bias = (torch.zeros_like(cross_attn_mask,
                                             dtype=dtype).masked_fill_(
                                                 cross_attn_mask, -math.inf))
 
         if not is_fake_hpu() and htorch.utils.internal.is_lazy():
             cross_block_mapping = torch.nn.functional.one_hot(
-                metadata.cross_block_groups, num_classes=batch_size)
+                cross_metadata.block_groups, num_classes=batch_size)
         else:
             # Unfortunately one_hot on CPU/torch.compile mode/eager mode
             # doesn't handle out of bounds classes so we need to convert
             # all negative values to 0 (block_mapping) or bs (block_groups)
-            cross_block_groups = metadata.cross_block_groups.to(torch.long)
+            cross_block_groups = cross_metadata.block_groups.to(torch.long)
             cross_block_mapping = torch.nn.functional.relu(cross_block_groups)
             cross_block_mapping = torch.nn.functional.one_hot(
                 cross_block_mapping, num_classes=batch_size)
             oob_values = cross_block_groups.lt(0)
             cross_block_mapping.masked_fill_(oob_values.unsqueeze(-1), 0)
             cross_block_groups.masked_fill_(oob_values, batch_size)
-            metadata = metadata._replace(cross_block_groups=cross_block_groups)
+            cross_metadata = cross_metadata._replace(
+                block_groups=cross_block_groups)
+        if self.use_flash_decode:
+            cross_block_segments = make_block_segments(
+                cross_metadata.block_groups, batch_size)
+            cross_metadata = cross_metadata._replace(
+                block_segments=cross_block_segments)
 
         cross_block_mapping = cross_block_mapping.to(dtype)
-        metadata = metadata._replace(cross_block_mapping=cross_block_mapping,
-                                     cross_attn_bias=cross_attn_bias)
-        return metadata
+        cross_metadata = cross_metadata._replace(
+            block_mapping=cross_block_mapping, attn_bias=cross_attn_bias)
+        return metadata._replace(cross=cross_metadata)
 
     def _set_cross_block_scales(self, metadata, device):
-        cross_block_mapping = metadata.cross_block_mapping
+        cross_metadata = metadata.cross
+        cross_block_mapping = cross_metadata.block_mapping
         ones = torch.ones((cross_block_mapping.size(0), ),
                           device=device,
                           dtype=cross_block_mapping.dtype)
         sums = batch2block(block2batch(ones, cross_block_mapping),
                            cross_block_mapping)
-        cross_block_scales = torch.reciprocal(torch.maximum(ones, sums))
-        metadata = metadata._replace(cross_block_scales=cross_block_scales)
-        return metadata
+        cross_block_scales = sums.clamp_min_(1.0).reciprocal_()
+        cross_metadata = cross_metadata._replace(
+            block_scales=cross_block_scales)
+        return metadata._replace(cross=cross_metadata)
 
     def _set_cross_indices_and_offsets(self, metadata, block_size):
-        cross_slot_mapping = metadata.cross_slot_mapping.flatten()
+        cross_metadata = metadata.cross
+        cross_slot_mapping = cross_metadata.slot_mapping.flatten()
         indices = torch.div(cross_slot_mapping,
                             block_size,
                             rounding_mode="floor")
         offsets = torch.fmod(cross_slot_mapping, block_size)
-        metadata = metadata._replace(cross_block_offsets=offsets,
-                                     cross_block_indices=indices)
-        return metadata
+        cross_metadata = cross_metadata._replace(block_offsets=offsets,
+                                                 block_indices=indices)
+        return metadata._replace(cross=cross_metadata)
 
     def _update_seq_lens(self, attn_metadata, batch_size, seq_len, device):
         # Set the seq_lens to after-padding sequence lengths to prevent
@@ -183,6 +195,9 @@ class EncoderDecoderModelInputForHPU(ModelInputForHPUWithSamplingMetadata):
         tensor_dict: Dict[str, Any],
         attn_backend: Optional["AttentionBackend"] = None,
     ) -> "EncoderDecoderModelInputForHPU":
+        cross_metadata = HPUCrossAttentionMetadata.pop_from_dict(tensor_dict)
+        if cross_metadata is not None:
+            tensor_dict["cross"] = cross_metadata
         return cast(
             EncoderDecoderModelInputForHPU,
             super().from_broadcasted_tensor_dict(tensor_dict, attn_backend))
@@ -281,9 +296,9 @@ class HPUEncoderDecoderModelRunner(
                         block_offset = i % self.block_size
                         slot = block_number * self.block_size + block_offset
                         cross_slot_mapping.append(slot)
-            attn_metadata.cross_slot_mapping = torch.tensor(cross_slot_mapping,
-                                                            dtype=torch.long,
-                                                            device=self.device)
+            attn_metadata.cross = HPUCrossAttentionMetadata(
+                slot_mapping=torch.tensor(
+                    cross_slot_mapping, dtype=torch.long, device=self.device))
         else:
             for seq_group_metadata in seq_group_metadata_list:
                 for _ in range(len(seq_group_metadata.seq_data)):
@@ -328,9 +343,10 @@ class HPUEncoderDecoderModelRunner(
             block_usage = block_usage.to(  # type: ignore
                 self.device, non_blocking=True)
 
-            attn_metadata.cross_block_list = block_list
-            attn_metadata.cross_block_groups = block_groups
-            attn_metadata.cross_block_usage = block_usage
+            attn_metadata.cross = HPUCrossAttentionMetadata(
+                block_list=block_list,
+                block_groups=block_groups,
+                block_usage=block_usage)
 
         # add padding to align with language model shapes
         real_batch_size = len(seq_group_metadata_list)
@@ -474,6 +490,19 @@ class HPUEncoderDecoderModelRunner(
         # input_hash(torch.tensor(123)) == input_hash(torch.tensor(321))
         # input_hash(123) != input_hash(321)
         # input_hash("abc") != input_hash("cba")
+        cross_metadata = subtuple(metadata.cross,
+                                  'TrimmedCrossAttentionMetadata', [
+                                      'block_indices',
+                                      'block_offsets',
+                                      'block_list',
+                                      'slot_mapping',
+                                      'block_mapping',
+                                      'block_groups',
+                                      'block_segments',
+                                      'block_scales',
+                                      'block_usage',
+                                      'attn_bias',
+                                  ])
         attention_metadata = subtuple(metadata, 'TrimmedAttentionMetadata', [
             'attn_bias',
             'seq_lens_tensor',
@@ -487,22 +516,14 @@ class HPUEncoderDecoderModelRunner(
             'block_offsets',
             'block_scales',
             'block_groups',
+            'block_segments',
             'num_prefill_tokens',
             'num_decode_tokens',
             'num_prefills',
             'seq_lens',
             'encoder_seq_lens',
             'encoder_seq_lens_tensor',
-            'cross_block_indices',
-            'cross_block_offsets',
-            'cross_block_list',
-            'cross_slot_mapping',
-            'cross_block_mapping',
-            'cross_block_groups',
-            'cross_block_scales',
-            'cross_block_usage',
-            'cross_attn_bias',
-        ])
+        ], {'cross': cross_metadata})
         return attention_metadata
 
     def _check_config(self, batch_size, seq_len, is_prompt, warmup_mode):
@@ -26,6 +26,8 @@ from vllm_hpu_extension.profiler import (HabanaHighLevelProfiler,
                                          HabanaMemoryProfiler, format_bytes)
 
 from vllm.attention import AttentionMetadata, get_attn_backend
+from vllm.attention.backends.hpu_attn import get_hpu_attention_flags
+from vllm.attention.ops.hpu_paged_attn import make_block_segments
 from vllm.config import DeviceConfig, VllmConfig
 from vllm.distributed import broadcast_tensor_dict
 from vllm.distributed.parallel_state import get_world_group
@@ -209,9 +211,9 @@ class HpuModelAdapter:
 
     def __init__(self, model, block_size, dtype, enforce_eager, layer_names):
         self.model = model
-        self.prefill_use_fusedsdpa = os.getenv('VLLM_PROMPT_USE_FUSEDSDPA',
-                                               '1').lower() in ['1', 'true'] \
-                                                and not is_fake_hpu()
+        flags = get_hpu_attention_flags()
+        self.prefill_use_fusedsdpa = flags.prefill_use_fusedsdpa
+        self.use_flash_decode = flags.use_flash_decode
         self.block_size = block_size
         self.dtype = dtype
         self.layer_names = layer_names
@@ -311,6 +313,12 @@ class HpuModelAdapter:
             block_mapping.masked_fill_(oob_values.unsqueeze(-1), 0)
             block_groups.masked_fill_(oob_values, batch_size)
             metadata = metadata._replace(block_groups=block_groups)
+        if self.use_flash_decode:
+            # Normalize the segment ids once per step rather than in every
+            # attention layer.
+            block_segments = make_block_segments(metadata.block_groups,
+                                                 batch_size)
+            metadata = metadata._replace(block_segments=block_segments)
         block_mapping = block_mapping.to(dtype)
         metadata = metadata._replace(block_mapping=block_mapping,
                                      attn_bias=attn_bias)
@@ -322,7 +330,7 @@ class HpuModelAdapter:
                           device=device,
                           dtype=block_mapping.dtype)
         sums = batch2block(block2batch(ones, block_mapping), block_mapping)
-        block_scales = torch.reciprocal(torch.maximum(ones, sums))
+        block_scales = sums.clamp_min_(1.0).reciprocal_()
         metadata = metadata._replace(block_scales=block_scales)
         return metadata
 
@@ -982,6 +990,7 @@ class HPUModelRunnerBase(ModelRunnerBase[TModelInputForHPU]):
             block_offsets=None,
             block_scales=None,
             block_groups=None,
+            block_segments=None,
             attn_bias=None,
             seq_lens=seq_lens,
             seq_lens_tensor=seq_lens_tensor,
@@ -1163,6 +1172,7 @@ class HPUModelRunnerBase(ModelRunnerBase[TModelInputForHPU]):
             block_offsets=None,
             block_scales=None,
             block_groups=block_groups,
+            block_segments=None,
             attn_bias=None,
             seq_lens_tensor=None,
             context_lens_tensor=None,
@@ -1384,6 +1394,7 @@ class HPUModelRunnerBase(ModelRunnerBase[TModelInputForHPU]):
             'block_offsets',
             'block_scales',
             'block_groups',
+            'block_segments',
         ])
         return attention_metadata
 